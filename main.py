@@ -1,37 +1,150 @@
 """Update Asana tasks with urgency based on custom fields."""
 
 import argparse
-import asana
+import asyncio
+import concurrent.futures
 import datetime
-import numpy
+import hashlib
+import math
+import operator
 import os
 import sys
-
-OPT_FIELDS = 'name,completed,due_on,start_on,custom_fields'
+import threading
+import time
+
+# Only request the task and custom field properties that are actually read
+OPT_FIELDS = ','.join([
+    'name',
+    'completed',
+    'due_on',
+    'custom_fields.gid',
+    'custom_fields.enum_value.name',
+    'custom_fields.date_value.date',
+])
+ORDER_OPT_FIELDS = ','.join([
+    'name',
+    'custom_fields.gid',
+    'custom_fields.number_value',
+])
+MAX_CONCURRENCY = 20
+BATCH_SIZE = 10
+PAGE_SIZE = 100
+MAX_RETRIES = 5
+RETRY_DELAY = 1.0
+RATE_BURST = 2.0
+CACHE_NAME = '.asana-cache'
+
+_IMPACT = {'Very High': 20, 'High': 10, 'Medium': 2, 'Low': 1}
+
+# Urgency multiplier keyed by business days remaining until the due date.
+# Overdue tasks share the -1 entry and tasks 10 or more days out share the
+# far multiplier; anything else is left unscaled.
+_DUE_MULT = {-1: 5, 0: 3, 1: 2, 2: 1.5, 3: 1.2, 4: 1.1}
+_DUE_MULT_FAR = 0.8
+
+# Per-thread count of responses served from the disk cache, so the rate
+# limiter can refund calls that never reached Asana
+_cache_hits = threading.local()
 
 
 def main():
     """Update Asana tasks with urgency based on custom fields."""
     args = parse_args(sys.argv[1:])
 
+    # The client libraries are slow to import, so only load them once the
+    # arguments are known to be valid
+    import asana
+    import requests
+
     client = asana.Client.access_token(args.personal_access_token)
+    if args.cache_expire_after > 0:
+        client.session = _cached_session(
+            args.personal_access_token, args.cache_expire_after)
     client.options['client_name'] = 'asana-todo-updater'
     client.headers['Asana-Disable'] = 'new_goal_memberships,new_user_task_lists'
 
-    args.func(args, client)
+    # Reuse connections across the concurrent requests; the adapter is
+    # mounted on the client's own session so it keeps its authentication.
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=MAX_CONCURRENCY,
+        pool_maxsize=MAX_CONCURRENCY,
+        max_retries=3)
+    client.session.mount('https://', adapter)
+
+    # Share one limiter across the whole run so every request draws from
+    # the same budget
+    limiter = RateLimiter(args.rate_limit, 60.0, MAX_CONCURRENCY)
+
+    asyncio.run(_run(args, client, limiter))
+
+
+async def _run(args, client, limiter):
+    """Run a command with a thread pool sized to the request concurrency.
+
+    Blocking client calls run in the loop's default executor, which is
+    otherwise too small for MAX_CONCURRENCY requests in flight.
+    """
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(MAX_CONCURRENCY))
+    await args.func(args, client, limiter)
+
+
+def _cached_session(access_token, expire_after):
+    """Create an Asana OAuth session that caches GET responses on disk.
+
+    Expired entries are revalidated using the ETag Asana returned with
+    them, so an unchanged resource costs a 304 rather than a full
+    response. Writes are never cached.
 
+    The cache file is named after a hash of the access token, since
+    requests-cache leaves the Authorization header out of its keys and
+    different tokens must not read each other's responses.
+    """
+    import asana
+    import requests_cache
 
-def order(args, client):
+    class CachedSession(requests_cache.CacheMixin,
+                        asana.session.AsanaOAuth2Session):
+        def send(self, request, **kwargs):
+            response = super().send(request, **kwargs)
+            if response.from_cache and not response.revalidated:
+                _cache_hits.count = getattr(_cache_hits, 'count', 0) + 1
+            return response
+
+    token_hash = hashlib.sha256(access_token.encode()).hexdigest()[:16]
+    session = CachedSession(
+        cache_name=f'{CACHE_NAME}-{token_hash}',
+        expire_after=expire_after,
+        allowable_methods=('GET',))
+    # CacheMixin only forwards arguments named in the session's signature,
+    # which the Asana session hides behind **kwargs
+    session.token = {'access_token': access_token}
+    return session
+
+
+def _asana_error():
+    """Return the Asana client's base error class.
+
+    asana is only imported once the arguments are parsed, so the class
+    can't be referenced at module level.
+    """
+    import asana
+    return asana.error.AsanaError
+
+
+async def order(args, client, limiter):
     """Order tasks in a section of a project."""
     # If we have a section to fix ordering on, do that first
     if args.section_gid is not None:
         # First, fetch all tasks from the section
         try:
-            tasks = client.tasks.get_tasks_for_section(
+            tasks = [task async for task in _paginate(
+                limiter,
+                client.tasks.get_tasks_for_section,
                 args.section_gid,
-                {'opt_fields': OPT_FIELDS}
-            )
-        except asana.error.AsanaError as e:
+                {'opt_fields': ORDER_OPT_FIELDS}
+            )]
+        except _asana_error() as e:
             print(f"Asana error getting sections: {e}")
             return
         except Exception as e:
@@ -43,172 +156,351 @@ def order(args, client):
         toSort = []
         for task in tasks:
             # First parse out all the fields we'll need
-            fields = {}
-            for field in task['custom_fields']:
-                fields[field['gid']] = field
+            fields = _custom_fields(task)
 
+            order = parse_number_field(fields, args.order_field_gid)
             toSort.append({
                 'name': task['name'],
                 'gid': task['gid'],
-                'order': parse_number_field(fields, args.order_field_gid)
+                'order': order,
+                '_k': order if order is not None else math.inf
             })
-        didSort = sorted(toSort, key=lambda x: (x['order'] is None, x['order']))
+        didSort = sorted(toSort, key=operator.itemgetter('_k'))
 
-        # Finally, re-order the tasks one by one.
+        # Finally, re-order the tasks in batches.
+        updates = []
+        lines = []
         order = 0
         for task in didSort:
             order += 10
-            try:
-                if task['order'] is not None:
-                    print(f"Setting order: {order} => {task['name']}")
-                    client.tasks.update_task(task['gid'], {
-                        'custom_fields': {
-                            args.order_field_gid: order
-                        }
-                    })
-                else:
-                    print(f"Not ordering: {task['name']}")
-            except asana.error.AsanaError as e:
-                print(f"{task['name']} => Asana error ordering task: {e}")
-                return
-            except Exception as e:
-                print(f"{task['name']} => Unknown error ordering task: {e}")
-                return
+            if task['order'] is not None:
+                lines.append(f"Setting order: {order} => {task['name']}")
+                updates.append((task['name'], task['gid'], {
+                    args.order_field_gid: order
+                }))
+            else:
+                lines.append(f"Not ordering: {task['name']}")
+        _write_lines(lines)
+
+        await asyncio.gather(*(
+            _update_batch(client, limiter, updates[i:i + BATCH_SIZE], 'ordering')
+            for i in range(0, len(updates), BATCH_SIZE)
+        ))
         return
 
 
-def urgency(args, client):
+async def urgency(args, client, limiter):
     """Update urgency of tasks in a project."""
-    # Retrieve all incomplete tasks in the specific project
-    try:
-        tasks = client.tasks.get_tasks({
-            'project': args.project_gid,
-            'completed_since': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-            'opt_fields': OPT_FIELDS
-        })
-    except asana.error.AsanaError as e:
-        print(f"Asana error getting project tasks: {e}")
-        return
-    except Exception as e:
-        print(f"Unknown error getting project tasks: {e}")
-        return
+    # Retrieve all incomplete tasks in the specific project. Pages are
+    # fetched lazily, so fetch errors are reported by _assign_urgency.
+    tasks = _paginate(limiter, client.tasks.get_tasks, {
+        'project': args.project_gid,
+        'completed_since': 'now',
+        'opt_fields': OPT_FIELDS
+    })
+    await _assign_urgency(args, client, limiter, tasks)
 
-    _assign_urgency(args, client, tasks)
 
-
-def task(args, client):
+async def task(args, client, limiter):
     """Update urgency of specific tasks."""
     try:
-        tasks = [client.tasks.get_task(gid, {
+        tasks = await asyncio.gather(*(limiter.call(client.tasks.get_task, gid, {
             'opt_fields': OPT_FIELDS
-        }) for gid in args.task_gids]
-    except asana.error.AsanaError as e:
+        }) for gid in args.task_gids))
+    except _asana_error() as e:
         print(f"Asana error getting specific tasks: {e}")
         return
     except Exception as e:
         print(f"Unknown error getting specific tasks: {e}")
         return
 
-    _assign_urgency(args, client, tasks)
+    await _assign_urgency(args, client, limiter, _each(tasks))
+
 
+async def _assign_urgency(args, client, limiter, tasks):
+    """Assign urgency to tasks based on custom fields.
+
+    Tasks are read from an async iterable. If fetching them fails part way
+    through, the tasks already read are still updated.
+    """
+    today = datetime.date.today()
+
+    # Update urgency for each task as it arrives, submitting each batch of
+    # updates while the remaining tasks are still being fetched
+    pending = []
+    batch = []
+    lines = []
+    tasks = aiter(tasks)
+    try:
+        while True:
+            try:
+                task = await anext(tasks)
+            except StopAsyncIteration:
+                break
+            except _asana_error() as e:
+                print(f"Asana error getting tasks: {e}")
+                break
+            except Exception as e:
+                print(f"Unknown error getting tasks: {e}")
+                break
+
+            # First parse out all the fields we'll need
+            fields = _custom_fields(task)
+
+            name = task['name']
+            completed = parse_bool_field(task, 'completed')
+            due_on = parse_date_field(task, 'due_on')
+            open_date = parse_date_custom_field(fields, args.open_date_field_gid)
+            impact = parse_enum_custom_field(fields, args.impact_field_gid)
+            size = parse_enum_custom_field(fields, args.size_field_gid)
+
+            # Can skip tasks that are already completed
+            if completed:
+                continue
+
+            # Can skip tasks that aren't small enough to work on specifically
+            if size == 'Holder':
+                continue
+
+            # Compute desired urgency value
+            urgency = compute_urgency(due_on, open_date, impact, today)
+
+            # Update only the urgency field on the source task
+            lines.append(f"{name} => {urgency}")
+            batch.append((name, task['gid'], {
+                args.urgency_field_gid: urgency
+            }))
+            if len(batch) == BATCH_SIZE:
+                _write_lines(lines)
+                pending.append(asyncio.create_task(
+                    _update_batch(client, limiter, batch, 'updating')))
+                batch = []
+                lines = []
+    finally:
+        # Always let submitted batches finish, even if parsing a task
+        # raised, so no update that was reported gets cancelled
+        if batch:
+            _write_lines(lines)
+            pending.append(asyncio.create_task(
+                _update_batch(client, limiter, batch, 'updating')))
+
+        await asyncio.gather(*pending)
+
+
+async def _update_batch(client, limiter, batch, action):
+    """Update custom fields of tasks through the batch API.
+
+    Each update in the batch is a (name, gid, custom_fields) tuple, and a
+    batch holds at most BATCH_SIZE updates. Updates rejected by the rate
+    limit are retried after the delay Asana asks for.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        actions = [{
+            'relative_path': f'/tasks/{gid}',
+            'method': 'put',
+            'data': {'custom_fields': custom_fields}
+        } for _, gid, custom_fields in batch]
+
+        try:
+            results = await limiter.call(
+                _flush_batch, client, actions, cost=len(actions))
+        except _asana_error() as e:
+            _write_lines([
+                f"{name} => Asana error {action} task: {e}"
+                for name, _, _ in batch
+            ])
+            return
+        except Exception as e:
+            _write_lines([
+                f"{name} => Unknown error {action} task: {e}"
+                for name, _, _ in batch
+            ])
+            return
+
+        retry = []
+        delay = 0
+        lines = []
+        for update, result in zip(batch, results):
+            if result['status_code'] == 429 and attempt < MAX_RETRIES:
+                retry.append(update)
+                delay = max(delay, _retry_after(result, attempt))
+            elif result['status_code'] >= 400:
+                lines.append(f"{update[0]} => Asana error {action} task: {_batch_error(result)}")
+        _write_lines(lines)
+
+        if not retry:
+            return
 
-def _assign_urgency(args, client, tasks):
-    """Assign urgency to tasks based on custom fields."""
-    # Update urgency for each task
-    for task in tasks:
+        batch = retry
+        await asyncio.sleep(delay)
 
-        # First parse out all the fields we'll need
-        fields = {}
-        for field in task['custom_fields']:
-            fields[field['gid']] = field
 
-        name = task['name']
-        completed = parse_bool_field(task, 'completed')
-        due_on = parse_date_field(task, 'due_on')
-        open_date = parse_date_custom_field(fields, args.open_date_field_gid)
-        impact = parse_enum_custom_field(fields, args.impact_field_gid)
-        size = parse_enum_custom_field(fields, args.size_field_gid)
+def _write_lines(lines):
+    """Write a group of status lines to stdout in a single call."""
+    if lines:
+        sys.stdout.write('\n'.join(lines) + '\n')
 
-        # Can skip tasks that are already completed
-        if completed:
-            continue
 
-        # Can skip tasks that aren't small enough to work on specifically
-        if size == 'Holder':
-            continue
+def _flush_batch(client, actions):
+    """Submit a group of actions to the Asana batch API."""
+    return client.batch_api.create_batch_request({'actions': actions})
 
-        # Compute desired urgency value
-        urgency = compute_urgency(due_on, open_date, impact)
 
-        # Update only the urgency field on the source task
+def _batch_error(result):
+    """Format the error of a failed batch action."""
+    body = result.get('body') or {}
+    messages = [error['message'] for error in body.get('errors', [])]
+    return f"{result['status_code']}: {'; '.join(messages)}"
+
+
+def _retry_after(result, attempt):
+    """Return how long to wait before retrying a rate limited batch action.
+
+    Uses the Retry-After header when Asana sends one as a number of
+    seconds, falling back to an exponential backoff otherwise.
+    """
+    headers = result.get('headers') or {}
+    retry_after = headers.get('Retry-After') or headers.get('retry-after')
+    if retry_after is not None:
         try:
-            client.tasks.update_task(task['gid'], {
-                'custom_fields': {
-                    args.urgency_field_gid: urgency
-                }
-            })
-        except asana.error.AsanaError as e:
-            print(f"{name} => Asana error updating task: {e}")
-        except Exception as e:
-            print(f"{name} => Unknown error updating task: {e}")
+            return float(retry_after)
+        except (TypeError, ValueError):
+            pass
+
+    return RETRY_DELAY * 2 ** attempt
+
+
+class RateLimiter:
+    """Token bucket limiting the rate and concurrency of client calls.
+
+    The bucket starts empty and holds at most `burst` seconds' worth of
+    tokens (but always enough for a full batch), so no window of `per`
+    seconds sees much more than `rate` requests.
+    """
+
+    def __init__(self, rate, per, concurrency, burst=RATE_BURST):
+        self.rate = rate
+        self.per = per
+        self.capacity = max(BATCH_SIZE, rate / per * burst)
+        self._tokens = 0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._sem = asyncio.Semaphore(concurrency)
+
+    async def acquire(self, cost=1):
+        """Wait until the bucket holds enough tokens, then take them."""
+        cost = min(cost, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated) * self.rate / self.per)
+                self._updated = now
+                if self._tokens >= cost:
+                    self._tokens -= cost
+                    return
+
+                await asyncio.sleep((cost - self._tokens) * self.per / self.rate)
+
+    async def call(self, func, *args, cost=1, **kwargs):
+        """Run a blocking client call in a thread once the limits allow.
+
+        The cost is the number of API requests the call makes, so a batch
+        request is charged for each of its actions.
+        """
+        async with self._sem:
+            await self.acquire(cost)
+            result, hits = await asyncio.to_thread(
+                _count_cache_hits, func, *args, **kwargs)
+
+        # Responses served from the disk cache never reached Asana, so
+        # give their tokens back
+        if hits:
+            self._tokens = min(self.capacity, self._tokens + hits)
+        return result
+
+
+def _count_cache_hits(func, *args, **kwargs):
+    """Run a client call, returning its result and the cache hits it had."""
+    _cache_hits.count = 0
+    result = func(*args, **kwargs)
+    return result, _cache_hits.count
+
+
+async def _paginate(limiter, fetch, *args):
+    """Yield the items of a collection, fetching it a page at a time.
+
+    Takes a client collection method, such as client.tasks.get_tasks, and
+    its arguments. Each page is a separate request through the limiter,
+    so pagination is charged against the rate limit like any other call.
+    """
+    offset = None
+    while True:
+        options = {
+            'iterator_type': None,
+            'full_payload': True,
+            'limit': PAGE_SIZE
+        }
+        if offset is not None:
+            options['offset'] = offset
+
+        page = await limiter.call(fetch, *args, **options)
+        for item in page['data']:
+            yield item
+
+        next_page = page.get('next_page')
+        if not next_page:
+            return
+        offset = next_page['offset']
+
+
+async def _each(items):
+    """Yield from a list of already fetched items."""
+    for item in items:
+        yield item
 
-        print(f"{name} => {urgency}")
+
+def _custom_fields(task):
+    """Return the task's custom fields keyed by gid, cached on the task."""
+    fields = task.get('_cf')
+    if fields is None:
+        fields = {field['gid']: field for field in task['custom_fields']}
+        task['_cf'] = fields
+    return fields
 
 
 def parse_enum_custom_field(fields, field_gid):
     """Parse an enum custom field from the fields dictionary."""
-    try:
-        return fields[field_gid]['enum_value']['name']
-    except TypeError:
-        return None
-    except KeyError:
+    enum_value = fields.get(field_gid, {}).get('enum_value')
+    if enum_value is None:
         return None
 
+    return enum_value.get('name')
+
 
 def parse_date_custom_field(fields, field_gid):
     """Parse a date custom field from the fields dictionary."""
-    datestr = ''
-    try:
-        datestr = fields[field_gid]['date_value']['date']
-    except TypeError:
-        return None
-    except KeyError:
+    date_value = fields.get(field_gid, {}).get('date_value')
+    if date_value is None:
         return None
 
-    return parse_date(datestr)
+    return parse_date(date_value.get('date'))
 
 
 def parse_bool_field(fields, field_name):
     """Parse a boolean field from the fields dictionary."""
-    fieldval = None
-    try:
-        fieldval = fields[field_name]
-    except KeyError:
-        return False
-
-    try:
-        return bool(fieldval)
-    except ValueError:
-        return False
+    return bool(fields.get(field_name, False))
 
 
 def parse_number_field(fields, field_gid):
     """Parse a number field from the fields dictionary."""
-    try:
-        return fields[field_gid]['number_value']
-    except KeyError:
-        return None
+    return fields.get(field_gid, {}).get('number_value')
 
 
 def parse_date_field(fields, field_name):
     """Parse a date field from the fields dictionary."""
-    datestr = ''
-    try:
-        datestr = fields[field_name]
-    except KeyError:
-        return None
-
-    return parse_date(datestr)
+    return parse_date(fields.get(field_name))
 
 
 def parse_date(datestr):
@@ -222,44 +514,21 @@ def parse_date(datestr):
         return None
 
 
-def compute_urgency(due_on, open_date, impact):
+def compute_urgency(due_on, open_date, impact, today):
     """Compute urgency value based on due date, open date, and impact."""
-    urgency = 0
-
-    match impact:
-        case 'Very High':
-            urgency += 20
-        case 'High':
-            urgency += 10
-        case 'Medium':
-            urgency += 2
-        case 'Low':
-            urgency += 1
-        case None:
-            return 0
+    if impact is None:
+        return 0
+
+    urgency = _IMPACT.get(impact, 0)
 
     if due_on is not None:
-        remaining_days = numpy.busday_count(datetime.date.today(), due_on)
-
-        if remaining_days < 0:
-            urgency *= 5
-        elif remaining_days == 0:
-            urgency *= 3
-        elif remaining_days == 1:
-            urgency *= 2
-        elif remaining_days == 2:
-            urgency *= 1.5
-        elif remaining_days == 3:
-            urgency *= 1.2
-        elif remaining_days == 4:
-            urgency *= 1.1
-        elif remaining_days >= 10:
-            urgency *= 0.8
-        elif remaining_days == 20:
-            urgency *= 0.5
+        remaining_days = max(_weekday_count(today, due_on), -1)
+        urgency *= _DUE_MULT.get(
+            remaining_days,
+            _DUE_MULT_FAR if remaining_days >= 10 else 1)
 
     if open_date is not None:
-        open_days = numpy.busday_count(open_date, datetime.date.today())
+        open_days = _weekday_count(open_date, today)
         open_weeks = open_days // 5
         if open_weeks > 0 and open_weeks < 10:
             urgency += open_weeks * 0.5
@@ -269,6 +538,42 @@ def compute_urgency(due_on, open_date, impact):
     return urgency
 
 
+def _weekday_count(begin, end):
+    """Count the weekdays in [begin, end).
+
+    Equivalent to numpy.busday_count with the default Monday-Friday week,
+    including its handling of reversed ranges: if end is before begin, the
+    weekdays in (end, begin] are counted and negated.
+    """
+    if end < begin:
+        day = datetime.timedelta(days=1)
+        return -_weekday_count(end + day, begin + day)
+
+    whole_weeks, remainder = divmod((end - begin).days, 7)
+    count = whole_weeks * 5
+
+    # Add the weekdays in the leftover partial week, which may wrap past
+    # Sunday into the following week
+    start = begin.weekday()
+    stop = start + remainder
+    count += min(stop, 5) - min(start, 5)
+    if stop > 7:
+        count += min(stop - 7, 5)
+
+    return count
+
+
+def _positive_int(value):
+    """Parse a strictly positive integer CLI argument."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an integer: {value}")
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be positive: {value}")
+    return number
+
+
 def parse_args(argv=None):
     """Parse CLI arguments."""
     parser = argparse.ArgumentParser(
@@ -305,6 +610,20 @@ def parse_args(argv=None):
         default=os.environ.get('ORDER_FIELD_GID', '1206071193914820'),
         help='gid of custom field holding order')
 
+    parser.add_argument(
+        '--cache-expire-after',
+        type=int,
+        default=os.environ.get('CACHE_EXPIRE_AFTER', '0'),
+        help='seconds to cache fetched tasks on disk, 0 to disable; order '
+             'then sorts on cached order values, which can undo manual '
+             'reordering done within that time')
+
+    parser.add_argument(
+        '--rate-limit',
+        type=_positive_int,
+        default=os.environ.get('RATE_LIMIT', '150'),
+        help='maximum Asana API requests per minute; raise for paid plans')
+
     # Commands
     subparsers = parser.add_subparsers(
         title='commands',